@@ -1,23 +1,38 @@
+import asyncio
+import hashlib
+import hmac
 import os
 import sqlite3
 import time
-from typing import Optional
+from contextlib import asynccontextmanager, closing
+from typing import Annotated, List, Optional
 
+import aiosqlite
+from cachetools import TTLCache
 from fastapi import FastAPI, Header, HTTPException
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from pydantic import BaseModel, StringConstraints
 from pathlib import Path
 
 # =========================================================
 # App
 # =========================================================
-APP = FastAPI()
+# orjson serializa as respostas JSON (ex.: listagem de devices) em C
+APP = FastAPI(default_response_class=ORJSONResponse)
 
 # =========================================================
 # Config
 # =========================================================
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+_ADMIN_TOKEN_B = ADMIN_TOKEN.encode("utf-8")
 DB_PATH = os.getenv("LICENSE_DB", "license.db")
+DB_POOL_SIZE = int(os.getenv("LICENSE_DB_POOL_SIZE", "8"))
+WAL_CHECKPOINT_INTERVAL = float(os.getenv("LICENSE_DB_CHECKPOINT_SECONDS", "60"))
+TOUCH_FLUSH_INTERVAL = float(os.getenv("LICENSE_DB_FLUSH_SECONDS", "0.5"))
+TOUCH_MAX_PENDING = int(os.getenv("LICENSE_DB_FLUSH_MAX_PENDING", "1000"))
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_SECONDS", "30"))
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "10000"))
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT_SECONDS", "2"))
 
 # =========================================================
 # DB Helpers
@@ -26,13 +41,188 @@ def get_db():
     # check_same_thread=False ajuda em alguns ambientes com múltiplas threads
     return sqlite3.connect(DB_PATH, check_same_thread=False)
 
+# SQL dos caminhos quentes. O sqlite3 guarda os statements preparados por
+# conexão, indexados pelo texto do SQL; usar sempre as mesmas strings faz
+# com que cada conexão do pool compile cada query uma única vez.
+_SQL = {
+    "check_select": "SELECT status FROM devices WHERE company_key=? AND device_id=?",
+    # Primeira vez: cria como PENDING. Se o device já existe, não toca na linha
+    # (nada de delete + reinsert do INSERT OR REPLACE) e não devolve nada.
+    "check_insert": """
+        INSERT INTO devices
+        (company_key, device_id, hostname, pc_name, requester_name, establishment, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'PENDING', ?, ?)
+        ON CONFLICT(company_key, device_id) DO NOTHING
+        RETURNING status
+    """,
+    # Heartbeat de device já existente, gravado em lote (ver _flush_touches).
+    # Atualiza dados do device SEM travar em strings vazias.
+    # Se no banco estiver "", tratamos como NULL (NULLIF) para permitir atualização posterior.
+    "check_touch": """
+        UPDATE devices
+        SET hostname = COALESCE(NULLIF(hostname, ''), ?),
+            pc_name = COALESCE(NULLIF(pc_name, ''), ?),
+            requester_name = COALESCE(NULLIF(requester_name, ''), ?),
+            establishment = COALESCE(NULLIF(establishment, ''), ?),
+            updated_at = ?
+        WHERE company_key=? AND device_id=?
+    """,
+    "admin_set_status": """
+        UPDATE devices
+        SET status=?, updated_at=?
+        WHERE company_key=? AND device_id=?
+    """,
+    "admin_list": """
+        SELECT company_key, device_id, hostname, pc_name, requester_name, establishment,
+               status, created_at, updated_at
+        FROM devices
+        WHERE company_key=?
+        ORDER BY updated_at DESC
+    """,
+}
+
+# Colunas de "admin_list", na mesma ordem do SELECT
+_DEVICE_COLUMNS = (
+    "company_key", "device_id", "hostname", "pc_name", "requester_name",
+    "establishment", "status", "created_at", "updated_at",
+)
+
+# Pool de conexões do processo: evita abrir/fechar o arquivo a cada request
+# e preserva o cache de páginas do SQLite entre chamadas.
+# O SQLite só aceita um escritor por vez, então as escritas passam por uma
+# conexão dedicada (_WRITER, serializada por _WRITE_LOCK) e as leituras usam
+# o pool de conexões somente leitura (_READERS).
+_READERS: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue(maxsize=DB_POOL_SIZE)
+_WRITER: Optional[aiosqlite.Connection] = None
+_WRITE_LOCK = asyncio.Lock()
+
+# Aplicados de uma vez (executescript) ao abrir cada conexão do pool
+_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+    PRAGMA wal_autocheckpoint=1000;
+"""
+_READER_PRAGMAS = _PRAGMAS + "PRAGMA query_only=ON;\n"
+
+async def _open_pooled(readonly: bool = False) -> aiosqlite.Connection:
+    # isolation_level=None -> autocommit (cada statement já é uma transação)
+    con = await aiosqlite.connect(
+        DB_PATH,
+        isolation_level=None,
+        cached_statements=256,
+    )
+    await con.executescript(_READER_PRAGMAS if readonly else _PRAGMAS)
+    return con
+
+@asynccontextmanager
+async def _acquire():
+    con = await _READERS.get()
+    try:
+        yield con
+    finally:
+        _READERS.put_nowait(con)
+
+@asynccontextmanager
+async def _acquire_writer():
+    async with _WRITE_LOCK:
+        try:
+            yield _WRITER
+        except BaseException:
+            if _WRITER.in_transaction:
+                await _WRITER.rollback()
+            raise
+
+async def _checkpoint_loop():
+    # Checkpoint PASSIVE periódico para o WAL não crescer sem limite
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            async with _acquire_writer() as con:
+                await con.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error:
+            pass  # tenta de novo no próximo ciclo
+
+# Heartbeats de devices já conhecidos: em vez de um commit por /api/check,
+# guardamos só o mais recente de cada device e gravamos tudo numa única
+# transação a cada TOUCH_FLUSH_INTERVAL. Não mexem em status, então as
+# leituras de status no banco continuam corretas sem consultar esta fila.
+_PENDING_TOUCHES: "dict[tuple[str, str], tuple]" = {}
+
+async def _touch(key: "tuple[str, str]", params: tuple):
+    # params = (hostname, pc_name, requester_name, establishment, updated_at, *key)
+    queued = _PENDING_TOUCHES.get(key)
+    if queued is not None:
+        # Mesma regra do UPDATE: o primeiro valor não vazio de cada campo vale
+        params = tuple(q or p for q, p in zip(queued[:4], params[:4])) + params[4:]
+    _PENDING_TOUCHES[key] = params
+    if len(_PENDING_TOUCHES) >= TOUCH_MAX_PENDING:
+        try:
+            await _flush_touches()
+        except sqlite3.Error:
+            pass  # o lote volta para a fila; _flush_loop tenta de novo
+
+async def _flush_touches():
+    if not _PENDING_TOUCHES:
+        return
+    batch = dict(_PENDING_TOUCHES)
+    _PENDING_TOUCHES.clear()
+    try:
+        async with _acquire_writer() as con:
+            await con.execute("BEGIN IMMEDIATE")
+            await con.executemany(_SQL["check_touch"], batch.values())
+            await con.commit()
+    except BaseException:
+        # Devolve o lote, sem sobrescrever heartbeats mais novos
+        for key, params in batch.items():
+            _PENDING_TOUCHES.setdefault(key, params)
+        raise
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(TOUCH_FLUSH_INTERVAL)
+        try:
+            await _flush_touches()
+        except sqlite3.Error:
+            pass  # tenta de novo no próximo ciclo
+
+# Cache do status por (company_key, device_id) para o /api/check.
+# Authorize/revoke atualizam o cache na hora; o TTL limita quanto tempo um
+# status alterado por outro processo (outro worker) pode ficar desatualizado.
+# _STATUS_GEN muda a cada alteração do admin, para que uma leitura feita
+# antes dela não seja gravada no cache depois.
+_STATUS_CACHE: "TTLCache[tuple[str, str], str]" = TTLCache(
+    maxsize=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL
+)
+_STATUS_GEN = 0
+
+def _set_status(key: "tuple[str, str]", status: str):
+    global _STATUS_GEN
+    _STATUS_GEN += 1
+    _STATUS_CACHE[key] = status
+
+def _forget_status(keys):
+    global _STATUS_GEN
+    _STATUS_GEN += 1
+    for key in keys:
+        _STATUS_CACHE.pop(key, None)
+
+_TASKS: "list[asyncio.Task]" = []
+
 def now_ts() -> int:
     return int(time.time())
 
 def init_db():
-    with get_db() as con:
+    # "with con" só faz commit/rollback; closing() garante o close()
+    with closing(get_db()) as con, con:
         cur = con.cursor()
 
+        # Com vários workers, cada processo roda init_db no import; o lock de
+        # escrita desde o início evita duas migrações ao mesmo tempo.
+        cur.execute("BEGIN IMMEDIATE")
+
         # Tabela (versão nova com campos extras)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS devices (
@@ -49,6 +239,12 @@ def init_db():
             )
         """)
 
+        # Listagem do admin: busca por company_key já na ordem de updated_at
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_devices_company_updated
+            ON devices (company_key, updated_at DESC)
+        """)
+
         # Migração para DB antigo (adiciona colunas se faltarem)
         cur.execute("PRAGMA table_info(devices)")
         cols = {row[1] for row in cur.fetchall()}
@@ -60,16 +256,54 @@ def init_db():
         if "establishment" not in cols:
             cur.execute("ALTER TABLE devices ADD COLUMN establishment TEXT")
 
+        # Migração única: versões antigas gravavam datas ISO
+        # (datetime.utcnow().isoformat()); converte para epoch em segundos.
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] < 1:
+            for col in ("created_at", "updated_at"):
+                cur.execute(f"""
+                    UPDATE devices
+                    SET {col} = COALESCE(CAST(strftime('%s', {col}) AS INTEGER), {col})
+                    WHERE typeof({col}) = 'text'
+                """)
+            cur.execute("PRAGMA user_version = 1")
+
         con.commit()
 
 init_db()
 
+@APP.on_event("startup")
+async def _pool_startup():
+    global _WRITER
+    _WRITER = await _open_pooled()
+    for _ in range(DB_POOL_SIZE):
+        _READERS.put_nowait(await _open_pooled(readonly=True))
+    _TASKS.append(asyncio.create_task(_checkpoint_loop()))
+    _TASKS.append(asyncio.create_task(_flush_loop()))
+
+@APP.on_event("shutdown")
+async def _pool_shutdown():
+    global _WRITER
+    for task in _TASKS:
+        task.cancel()
+    await asyncio.gather(*_TASKS, return_exceptions=True)
+    _TASKS.clear()
+    await _flush_touches()
+    while not _READERS.empty():
+        await _READERS.get_nowait().close()
+    if _WRITER is not None:
+        await _WRITER.close()
+        _WRITER = None
+
 # =========================================================
 # Models
 # =========================================================
+# Chaves obrigatórias: o pydantic já tira espaços e rejeita vazio (422)
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
 class CheckPayload(BaseModel):
-    company_key: str
-    device_id: str
+    company_key: NonEmptyStr
+    device_id: NonEmptyStr
     hostname: Optional[str] = None
 
     # Novos campos (para identificar solicitante e PC)
@@ -80,53 +314,79 @@ class CheckPayload(BaseModel):
     ts: Optional[int] = None
 
 class AdminDeviceAction(BaseModel):
-    company_key: str
-    device_id: str
+    company_key: NonEmptyStr
+    device_id: NonEmptyStr
+
+class AdminDeviceBulkAction(BaseModel):
+    company_key: NonEmptyStr
+    device_ids: List[NonEmptyStr]
 
 # =========================================================
 # Utils
 # =========================================================
 def require_admin(x_admin_token: Optional[str]):
-    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+    # compare_digest: tempo constante, não vaza o prefixo correto do token
+    if not _ADMIN_TOKEN_B or not hmac.compare_digest(
+        _ADMIN_TOKEN_B, (x_admin_token or "").encode("utf-8")
+    ):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 # =========================================================
 # Public
 # =========================================================
+# Respostas prontas: os health checks não montam dict nem passam pelo encoder
+_HEALTH_OK = Response(content=b'{"status":"ok"}', media_type="application/json")
+
 @APP.get("/health")
-def health():
-    return {"status": "ok"}
+async def health():
+    return _HEALTH_OK
 
 # Render está com Health Check em /healthz
 @APP.get("/healthz")
-def healthz():
-    return {"status": "ok"}
+async def healthz():
+    return _HEALTH_OK
+
+# Diferente de /healthz, confirma que o banco responde
+async def _ping_db():
+    # Lê uma página da tabela de verdade (SELECT 1 sozinho não toca no arquivo)
+    async with _acquire() as con:
+        await con.execute_fetchall("SELECT 1 FROM devices LIMIT 1")
+
+@APP.get("/ready")
+async def ready():
+    try:
+        await asyncio.wait_for(_ping_db(), READY_TIMEOUT)
+    except (sqlite3.Error, asyncio.TimeoutError):
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return _HEALTH_OK
 
 @APP.post("/api/check")
-def api_check(payload: CheckPayload):
+async def api_check(payload: CheckPayload):
     """
     POS chama este endpoint ao iniciar.
     - AUTHORIZED -> authorized: true
     - PENDING/REVOKED -> authorized: false
     - Primeira vez: cria registro PENDING (salva Nome/Estabelecimento/PC)
     """
-    with get_db() as con:
-        cur = con.cursor()
+    key = (payload.company_key, payload.device_id)
+    now = now_ts()
 
-        cur.execute(
-            "SELECT status FROM devices WHERE company_key=? AND device_id=?",
-            (payload.company_key, payload.device_id)
-        )
-        row = cur.fetchone()
-
-        if row is None:
-            # Primeira vez: cria como PENDING
-            cur.execute(
-                """
-                INSERT OR REPLACE INTO devices
-                (company_key, device_id, hostname, pc_name, requester_name, establishment, status, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
+    status = _STATUS_CACHE.get(key)
+    if status is None:
+        gen = _STATUS_GEN
+        async with _acquire() as con:
+            rows = await con.execute_fetchall(_SQL["check_select"], key)
+        if rows:
+            status = rows[0][0]
+            if gen == _STATUS_GEN:
+                _STATUS_CACHE[key] = status
+
+    created = False
+    if status is None:
+        async with _acquire_writer() as con:
+            # execute_fetchall consome o RETURNING até o fim, concluindo o statement (commit)
+            rows = await con.execute_fetchall(
+                _SQL["check_insert"],
                 (
                     payload.company_key,
                     payload.device_id,
@@ -134,138 +394,129 @@ def api_check(payload: CheckPayload):
                     payload.pc_name,
                     payload.requester_name,
                     payload.establishment,
-                    "PENDING",
-                    now_ts(),
-                    now_ts(),
+                    now,
+                    now,
                 )
             )
-            con.commit()
-            return {
-                "authorized": False,
-                "status": "PENDING",
-                "message": "Aguardando autorização do administrador"
-            }
-
-        status = row[0]
-
-        # Atualiza dados do device SEM travar em strings vazias.
-        # Se no banco estiver "", tratamos como NULL (NULLIF) para permitir atualização posterior.
-        cur.execute(
-            """
-            UPDATE devices
-            SET hostname = COALESCE(NULLIF(hostname, ''), ?),
-                pc_name = COALESCE(NULLIF(pc_name, ''), ?),
-                requester_name = COALESCE(NULLIF(requester_name, ''), ?),
-                establishment = COALESCE(NULLIF(establishment, ''), ?),
-                updated_at = ?
-            WHERE company_key=? AND device_id=?
-            """,
-            (
-                payload.hostname,
-                payload.pc_name,
-                payload.requester_name,
-                payload.establishment,
-                now_ts(),
-                payload.company_key,
-                payload.device_id,
-            )
-        )
-        con.commit()
+            created = bool(rows)
+            if not created:
+                # Outra request criou o device entre a leitura e o lock
+                rows = await con.execute_fetchall(_SQL["check_select"], key)
+            status = rows[0][0]
+            _STATUS_CACHE[key] = status
 
-        if status == "AUTHORIZED":
-            return {"authorized": True}
+    if not created:
+        # Device conhecido: o update de hostname/updated_at entra no lote
+        await _touch(key, (
+            payload.hostname,
+            payload.pc_name,
+            payload.requester_name,
+            payload.establishment,
+            now,
+            payload.company_key,
+            payload.device_id,
+        ))
 
-        return {
-            "authorized": False,
-            "status": status,
-            "message": "Aguardando autorização do administrador"
-        }
+    if status == "AUTHORIZED":
+        return {"authorized": True}
+
+    return {
+        "authorized": False,
+        "status": status,
+        "message": "Aguardando autorização do administrador"
+    }
 
 # =========================================================
 # Admin
 # =========================================================
 @APP.get("/admin/devices")
-def admin_list_devices(
-    company_key: str,
+async def admin_list_devices(
+    company_key: NonEmptyStr,
     x_admin_token: Optional[str] = Header(None)
 ):
     require_admin(x_admin_token)
-    with get_db() as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            SELECT company_key, device_id, hostname, pc_name, requester_name, establishment,
-                   status, created_at, updated_at
-            FROM devices
-            WHERE company_key=?
-            ORDER BY updated_at DESC
-            """,
-            (company_key,)
-        )
-        rows = cur.fetchall()
-        return [
-            {
-                "company_key": r[0],
-                "device_id": r[1],
-                "hostname": r[2],
-                "pc_name": r[3],
-                "requester_name": r[4],
-                "establishment": r[5],
-                "status": r[6],
-                "created_at": r[7],
-                "updated_at": r[8],
-            }
-            for r in rows
-        ]
+    async with _acquire() as con:
+        rows = await con.execute_fetchall(_SQL["admin_list"], (company_key,))
+    # Formato colunar: as linhas vão como tuplas, sem montar um dict por device
+    return ORJSONResponse({"columns": _DEVICE_COLUMNS, "rows": rows})
 
 @APP.post("/admin/device/authorize")
-def admin_authorize(
+async def admin_authorize(
     payload: AdminDeviceAction,
     x_admin_token: Optional[str] = Header(None)
 ):
     require_admin(x_admin_token)
-    with get_db() as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            UPDATE devices
-            SET status='AUTHORIZED', updated_at=?
-            WHERE company_key=? AND device_id=?
-            """,
-            (now_ts(), payload.company_key, payload.device_id)
-        )
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Device not found")
-        con.commit()
+    async with _acquire_writer() as con:
+        async with con.execute(
+            _SQL["admin_set_status"],
+            ("AUTHORIZED", now_ts(), payload.company_key, payload.device_id)
+        ) as cur:
+            updated = cur.rowcount
+    if updated == 0:
+        raise HTTPException(status_code=404, detail="Device not found")
+    _set_status((payload.company_key, payload.device_id), "AUTHORIZED")
     return {"ok": True}
 
 @APP.post("/admin/device/revoke")
-def admin_revoke(
+async def admin_revoke(
     payload: AdminDeviceAction,
     x_admin_token: Optional[str] = Header(None)
 ):
     require_admin(x_admin_token)
-    with get_db() as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            UPDATE devices
-            SET status='REVOKED', updated_at=?
-            WHERE company_key=? AND device_id=?
-            """,
-            (now_ts(), payload.company_key, payload.device_id)
-        )
-        if cur.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Device not found")
-        con.commit()
+    async with _acquire_writer() as con:
+        async with con.execute(
+            _SQL["admin_set_status"],
+            ("REVOKED", now_ts(), payload.company_key, payload.device_id)
+        ) as cur:
+            updated = cur.rowcount
+    if updated == 0:
+        raise HTTPException(status_code=404, detail="Device not found")
+    _set_status((payload.company_key, payload.device_id), "REVOKED")
     return {"ok": True}
 
+@APP.post("/admin/devices/authorize")
+async def admin_authorize_bulk(
+    payload: AdminDeviceBulkAction,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    Autoriza vários devices de uma vez, numa única transação.
+    Ids inexistentes são ignorados; "updated" diz quantos foram alterados.
+    """
+    require_admin(x_admin_token)
+    now = now_ts()
+    params = [
+        ("AUTHORIZED", now, payload.company_key, device_id)
+        for device_id in dict.fromkeys(payload.device_ids)  # sem repetidos
+    ]
+    async with _acquire_writer() as con:
+        await con.execute("BEGIN IMMEDIATE")
+        async with con.executemany(_SQL["admin_set_status"], params) as cur:
+            updated = cur.rowcount
+        await con.commit()
+    # Não sabemos quais ids existiam: limpa o cache e deixa o /api/check reler
+    _forget_status([(payload.company_key, d) for d in payload.device_ids])
+    return {"ok": True, "updated": updated}
+
 # =========================================================
 # Admin Panel (HTML)
 # =========================================================
+# Lido uma única vez no import; o ETag permite ao navegador revalidar com 304
+_ADMIN_HTML_PATH = Path(__file__).with_name("admin.html")
+_ADMIN_HTML = _ADMIN_HTML_PATH.read_bytes() if _ADMIN_HTML_PATH.exists() else None
+_ADMIN_HTML_HEADERS = (
+    {
+        "ETag": '"%s"' % hashlib.sha256(_ADMIN_HTML).hexdigest()[:32],
+        "Cache-Control": "no-cache",
+    }
+    if _ADMIN_HTML is not None
+    else {}
+)
+
 @APP.get("/admin-panel", response_class=HTMLResponse)
-def admin_panel():
-    p = Path(__file__).with_name("admin.html")
-    if not p.exists():
+async def admin_panel(if_none_match: Optional[str] = Header(None)):
+    if _ADMIN_HTML is None:
         raise HTTPException(status_code=404, detail="admin.html not found")
-    return HTMLResponse(p.read_text(encoding="utf-8"))
+    if if_none_match == _ADMIN_HTML_HEADERS["ETag"]:
+        return Response(status_code=304, headers=_ADMIN_HTML_HEADERS)
+    return HTMLResponse(content=_ADMIN_HTML, headers=_ADMIN_HTML_HEADERS)